@@ -0,0 +1,58 @@
+
+"""
+Compare the assembly of chunked similarity matrices through row assignment
+into a `lil_matrix` against `SparseAccumulator`. Both paths consume the same
+precomputed (thresholded) chunks, so only the assembly step is timed.
+
+    python benchmarks/sparse_assembly.py
+"""
+
+import timeit
+
+import numpy as np
+import scipy.sparse
+from sklearn.metrics.pairwise import pairwise_kernels
+from sklearn.preprocessing import normalize
+
+from retrieve.sparse_utils import sparse_chunks, set_threshold, SparseAccumulator
+
+
+def get_chunks(X, Y, chunk_size, threshold):
+    chunks = []
+    for (i_start, i_stop), Q in sparse_chunks(X, chunk_size):
+        Q_sims = pairwise_kernels(Q, Y, metric='linear')
+        chunks.append(((i_start, i_stop), set_threshold(Q_sims, threshold)))
+    return chunks
+
+
+def lil_assemble(chunks, shape):
+    sims = scipy.sparse.lil_matrix(shape)
+    for (i_start, i_stop), Q_sims in chunks:
+        sims[i_start:i_stop, :] = Q_sims
+    return sims.tocsr()
+
+
+def accumulator_assemble(chunks, shape):
+    sims = SparseAccumulator(shape)
+    for (i_start, _), Q_sims in chunks:
+        sims.add_chunk(i_start, Q_sims)
+    return sims.tocsr()
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(1001)
+    X = normalize(scipy.sparse.random(5000, 20000, density=0.001, random_state=rng))
+    Y = normalize(scipy.sparse.random(5000, 20000, density=0.001, random_state=rng))
+    shape = (X.shape[0], Y.shape[0])
+
+    for threshold in [0.0, 0.05, 0.25]:
+        for chunk_size in [100, 500, 2500]:
+            chunks = get_chunks(X, Y, chunk_size, threshold)
+            print(" - Run for threshold {:.2f} and chunk size {} ({} nonzeros)".format(
+                threshold, chunk_size, sum(Q_sims.nnz for _, Q_sims in chunks)))
+            assert (lil_assemble(chunks, shape) !=
+                    accumulator_assemble(chunks, shape)).nnz == 0
+            a = timeit.Timer(lambda: lil_assemble(chunks, shape)).timeit(number=3)
+            b = timeit.Timer(lambda: accumulator_assemble(chunks, shape)).timeit(number=3)
+            print("   - Runtime lil_matrix: {:.3f}".format(a))
+            print("   - Runtime accumulator: {:.3f}".format(b))
@@ -0,0 +1,69 @@
+
+"""
+Benchmark the top-k selection of `sparse_utils.top_k` against a full
+per-row argsort over similarity matrices with a skewed (log-normal)
+distribution of nonzero items per row, as produced by thresholded
+similarity searches.
+
+    python benchmarks/top_k.py
+"""
+
+import timeit
+
+import numba as nb
+import numpy as np
+import scipy.sparse
+
+from retrieve.sparse_utils import top_k
+
+
+@nb.njit()
+def argsort_top_k(data, indices, indptr, k):
+    nrows = indptr.shape[0] - 1
+    top_indices = np.zeros((nrows, k), dtype=indices.dtype) - 1
+    top_data = np.zeros((nrows, k), dtype=data.dtype) * np.nan
+    for i in range(nrows):
+        start, stop = indptr[i], indptr[i + 1]
+        top = np.argsort(data[start:stop])[::-1][:k]
+        n_items = min(len(top), k)
+        top_indices[i, 0:n_items] = indices[start:stop][top]
+        top_data[i, 0:n_items] = data[start:stop][top]
+    return top_indices, top_data
+
+
+def get_matrix(n, m, mean_nnz, rng):
+    # log-normal number of nonzero items per row
+    nnz = np.minimum(rng.lognormal(np.log(mean_nnz), 1.0, size=n).astype(int), m)
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(nnz)
+    indices = np.concatenate(
+        [rng.choice(m, size=size, replace=False) for size in nnz]).astype(np.int32)
+    data = rng.uniform(size=indptr[-1])
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=(n, m))
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(1001)
+    for mean_nnz in [50, 500, 5000]:
+        X = get_matrix(10000, 50000, mean_nnz, rng)
+        args = X.data, X.indices, X.indptr
+        for k in [5, 20, 100]:
+            # compile
+            argsort_top_k(*args, k), top_k(X, k), top_k(X, k, parallel=False)
+            print(" - Run for mean nnz {} ({} nonzeros) and k {}".format(
+                mean_nnz, X.nnz, k))
+            a = timeit.Timer(lambda: argsort_top_k(*args, k)).timeit(number=3)
+            b = timeit.Timer(lambda: top_k(X, k, parallel=False)).timeit(number=3)
+            c = timeit.Timer(lambda: top_k(X, k)).timeit(number=3)
+            print("   - Runtime argsort: {:.3f}".format(a))
+            print("   - Runtime top_k (serial): {:.3f}".format(b))
+            print("   - Runtime top_k (parallel): {:.3f}".format(c))
+        if mean_nnz <= 500:
+            dense = X[:2000].toarray()
+            top_k(dense, 20)
+            a = timeit.Timer(
+                lambda: np.argsort(-dense, axis=1)[:, :20]).timeit(number=3)
+            b = timeit.Timer(lambda: top_k(dense, 20)).timeit(number=3)
+            print(" - Dense input, k 20")
+            print("   - Runtime np.argsort: {:.3f}".format(a))
+            print("   - Runtime top_k (parallel): {:.3f}".format(b))
@@ -4,55 +4,53 @@ import contextlib
 import collections
 
 import numpy as np
+import scipy.sparse
 
 from retrieve import sparse_utils
 
 
-def _get_matches_fneg_tpos_at(q_idxs, i_idxs, ranking, at, strict):
-    matches = []
-    # [[i, i, i, ... (len(q_idxs))],
-    #  [j, j, j, ...], ...
-    i_idxs_array = np.repeat(i_idxs[:, None], len(q_idxs), 1)
-    # [i, j, k, i, j, k, ... len(q_idxs)]
-    i_idxs_array = np.ravel(i_idxs_array.T)
-    q_idxs_array = np.repeat(ranking[q_idxs, :at], len(i_idxs), axis=0)
-
-    row_matches, row_ranks = np.where(i_idxs_array[:, None] == q_idxs_array)
-    # x-axis gives matches:
-    # - rows of q_idxs (mod len i_idxs)
-    # - rows of i_idxs (div len i_idxs)
-    q_matches, i_matches = divmod(row_matches, len(i_idxs))
-    # get original row and col indices
-    q_matches, i_matches = q_idxs[q_matches], i_idxs[i_matches]
-    # collect matches
-    for q_match, i_match, rank in zip(q_matches.tolist(),
-                                      i_matches.tolist(),
-                                      row_ranks.tolist()):
-        # rank should be 1-index
-        matches.append((q_match, i_match, rank + 1))
-
-    if strict:
-        # how many were strictly retrieved
-        tpos = len(q_matches)
-        # how many of the many-to-many links were not retrieved
-        fneg = len(q_idxs) * len(i_idxs) - len(q_matches)
-    else:
-        # at least one was retrieved
-        # consider the whole match holistically
-        tpos = int(len(matches) != 0)
-        fneg = int(len(matches) == 0)
-
-    return matches, tpos, fneg
+def _get_ref_ranks(ranking, refs, at):
+    # encode all (query, indexed) pairs in the refs as flat arrays and look up
+    # the (1-indexed) rank of each pair within the first `at` items of the
+    # ranking with a sorted join (0 if the indexed doc wasn't retrieved)
+    pairs = [(ref_id, q_idx, i_idx) for ref_id, (q_idxs, i_idxs) in enumerate(refs)
+             for q_idx in q_idxs for i_idx in i_idxs]
+    ref_ids, q_idxs, i_idxs = np.array(pairs, dtype=np.int64).reshape(-1, 3).T
 
+    ranking = ranking[:, :at]
+    rows, ranks = np.nonzero(_get_retrieved_at(ranking, at))
+    cols = ranking[rows, ranks].astype(np.int64)
+    width = max(cols.max(initial=0), i_idxs.max(initial=0)) + 1
+    # add a sentinel so that lookups past the last key stay in bounds
+    keys = np.append(rows * width + cols, -1)
+    ranks = np.append(ranks, -1)
+    order = np.argsort(keys[:-1])
+    keys[:-1], ranks[:-1] = keys[order], ranks[order]
+    pair_keys = q_idxs * width + i_idxs
+    pos = np.searchsorted(keys[:-1], pair_keys)
+    pair_ranks = np.where(keys[pos] == pair_keys, ranks[pos] + 1, 0)
 
-def _get_fpos_at(unchecked, ranking, at):
+    return ref_ids, q_idxs, i_idxs, pair_ranks
+
+
+def _get_retrieved_at(ranking, at):
     # empty ranks are represented as -1
+    return ranking[:, :at] >= 0
+
+
+def _get_fpos_at(unchecked, ranking, at):
     # considers a false positive if at least one indexed doc is retrieved within
     # the first ranked `at` documents
-    fpos = np.sum(np.any(0 < ranking[unchecked, :at], axis=1))
+    fpos = np.sum(np.any(_get_retrieved_at(ranking[unchecked], at), axis=1))
     return fpos
 
 
+def _get_fpos_scores_at(ranking, scores, at):
+    # highest score of a retrieved doc within the first ranked `at` documents
+    retrieved = _get_retrieved_at(ranking, at)
+    return np.where(retrieved, scores[:, :at], -np.inf).max(1, initial=-np.inf)
+
+
 def ranking_stats_from_tuples(ranking, refs, at_values=(1, 5, 10, 20), strict=False):
     """
     Computes evaluation stats (true positives, false negatives and false positives)
@@ -121,32 +119,28 @@ def ranking_stats_from_tuples(ranking, refs, at_values=(1, 5, 10, 20), strict=Fa
     #            [ 2.,  3., -1,  -1,  -1, -1],  # tpos
     #            [ 3.,  4.,  5., -1,  -1, -1],  # (tpos already checked)
     #            [ 4.,  5.,  6.,  7., -1, -1]]) # fneg & fpos
-    matches = []
-    stats = [collections.Counter() for _ in at_values]
-    checked = collections.defaultdict(list)
-
-    for q_idxs, i_idxs in refs:
-        q_idxs, i_idxs = np.array(q_idxs), np.array(i_idxs)
-        for idx_at, at in enumerate(sorted(at_values)):
-            row_matches, tpos, fneg = _get_matches_fneg_tpos_at(
-                q_idxs, i_idxs, ranking, at, strict)
-            stats[idx_at]['tpos'] += tpos
-            stats[idx_at]['fneg'] += fneg
-
-            # collect rank data only at the highest at
-            # the rank can be used to filter out by cutoff points later
-            if at == max(at_values):
-                matches.extend(row_matches)
-
-            if row_matches:
-                row_checked, _, _ = zip(*row_matches)
-                checked[at].extend(row_checked)
-
-    # false positives
-    for idx, at in enumerate(sorted(at_values)):
-        unchecked = np.arange(len(ranking))
-        unchecked = unchecked[np.isin(unchecked, np.array(checked[at]), invert=True)]
-        stats[idx]['fpos'] += _get_fpos_at(unchecked, ranking, at)
+    ref_ids, q_idxs, i_idxs, ranks = _get_ref_ranks(ranking, refs, max(at_values))
+    found = ranks > 0
+    # the rank can be used to filter out by cutoff points later
+    matches = list(zip(q_idxs[found].tolist(), i_idxs[found].tolist(),
+                       ranks[found].tolist()))
+
+    stats = []
+    for at in sorted(at_values):
+        hits = found & (ranks <= at)
+        if strict:
+            # how many of the many-to-many links were (not) retrieved
+            tpos = int(np.sum(hits))
+            fneg = len(ranks) - tpos
+        else:
+            # at least one link of the reference was retrieved
+            tpos = len(np.unique(ref_ids[hits]))
+            fneg = len(refs) - tpos
+        # false positives
+        unchecked = np.ones(len(ranking), dtype=bool)
+        unchecked[q_idxs[hits]] = False
+        fpos = _get_fpos_at(np.flatnonzero(unchecked), ranking, at)
+        stats.append(collections.Counter(tpos=tpos, fneg=fneg, fpos=fpos))
 
     return stats, matches
 
@@ -158,14 +152,7 @@ def f_score(p, r, beta=1):
     return (1 + beta ** 2) * ((p * r) / (((beta ** 2) * p) + r))
 
 
-def get_metrics(sims, refs, at_values=(1, 5, 10, 20), strict=False):
-    """
-    Get metrics from similarity metric and refs
-    """
-    ranking, sims = sparse_utils.top_k(sims, max(at_values))
-    stats, matches = ranking_stats_from_tuples(
-        ranking, refs, at_values=at_values, strict=strict)
-
+def _get_metrics_from_stats(stats, at_values):
     results = {}
     for at, stats in zip(at_values, stats):
         tpos, fneg, fpos = stats['tpos'], stats['fneg'], stats['fpos']
@@ -185,14 +172,120 @@ def get_metrics(sims, refs, at_values=(1, 5, 10, 20), strict=False):
     return results
 
 
-def get_thresholded_metrics(sims, refs, thresholds, copy=False):
-    metrics = collections.defaultdict(list)
+def get_metrics(sims, refs, at_values=(1, 5, 10, 20), strict=False):
+    """
+    Get metrics from similarity metric and refs
+    """
+    ranking, sims = sparse_utils.top_k(sims, max(at_values))
+    stats, matches = ranking_stats_from_tuples(
+        ranking, refs, at_values=at_values, strict=strict)
+
+    return _get_metrics_from_stats(stats, at_values)
+
+
+def ranking_stats_from_thresholds(ranking, scores, refs, thresholds,
+                                  at_values=(1, 5, 10, 20), strict=False):
+    """
+    Compute the same stats as `ranking_stats_from_tuples` for a list of
+    thresholds at once. Since thresholding a similarity matrix only removes the
+    lowest scored items from the ranking, a match (or a false positive) found
+    in the ranking survives a threshold if its score is above the threshold.
+    Therefore, the matches are only computed once, and the stats for all
+    thresholds are read off sorted arrays of scores.
+
+    Arguments
+    =========
 
-    for th in thresholds:
-        sims = sparse_utils.set_threshold(sims, th, copy=copy)
-        for metric, val in get_metrics(sims, refs).items():
+    ranking : np.array(n, top_k), ranking array (see `sparse_utils.top_k`)
+    scores : np.array(n, top_k), corresponding scores in descending order
+    refs : see `ranking_stats_from_tuples`
+    thresholds : list of floats
+    at_values : see `ranking_stats_from_tuples`
+    strict : see `ranking_stats_from_tuples`
+
+    Output
+    ======
+    stats : list with an entry per threshold, holding a list of dictionaries
+        as in the output of `ranking_stats_from_tuples`
+
+    >>> import numpy as np
+    >>> ranking = np.array([[1, 2, -1], [3, 0, -1], [2, 3, 1]])
+    >>> scores = np.array([[0.9, 0.3, np.nan], [0.8, 0.4, np.nan], [0.7, 0.6, 0.2]])
+    >>> refs = [([0], [2]), ([1], [0, 4])]
+    >>> stats = ranking_stats_from_thresholds(
+    ...     ranking, scores, refs, [0.1, 0.5], at_values=[1, 3])
+    >>> [[(s['tpos'], s['fneg'], s['fpos']) for s in th_stats] for th_stats in stats]
+    [[(0, 2, 3), (2, 0, 1)], [(0, 2, 3), (0, 2, 3)]]
+    >>> # same as dropping the items below threshold from the ranking
+    >>> ranking_th = np.where(scores >= 0.5, ranking, -1)
+    >>> ranking_stats_from_tuples(ranking_th, refs, at_values=[1, 3])[0] == stats[1]
+    True
+    """
+    at_values = sorted(at_values)
+    n_queries, max_at = len(ranking), max(at_values)
+
+    ref_ids, q_idxs, _, ranks = _get_ref_ranks(ranking, refs, max_at)
+    found = ranks > 0
+    match_scores = np.full(len(ranks), -np.inf)
+    match_scores[found] = scores[q_idxs[found], ranks[found] - 1]
+
+    # scores of the matches retrieved within each cutoff (for strict evaluation)
+    # or of the best match of each reference (for non strict evaluation)
+    ref_scores, n_refs = {}, len(ranks) if strict else len(refs)
+    # best score of the matches of each query, which are not false positives
+    checked_scores = {}
+    for at in at_values:
+        at_scores = np.where(found & (ranks <= at), match_scores, -np.inf)
+        if strict:
+            ref_scores[at] = at_scores[found & (ranks <= at)]
+        else:
+            ref_scores[at] = np.full(len(refs), -np.inf)
+            np.maximum.at(ref_scores[at], ref_ids, at_scores)
+        checked_scores[at] = np.full(n_queries, -np.inf)
+        np.maximum.at(checked_scores[at], q_idxs, at_scores)
+
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    stats = [[collections.Counter() for _ in at_values] for _ in thresholds]
+    for idx_at, at in enumerate(at_values):
+        tpos_scores = np.sort(ref_scores[at])
+        tpos = len(tpos_scores) - np.searchsorted(tpos_scores, thresholds)
+        # rows with a retrieved item at each cutoff, excluding checked rows
+        fpos_scores = _get_fpos_scores_at(ranking, scores, at)
+        checked = np.sort(np.minimum(fpos_scores, checked_scores[at]))
+        fpos_scores = np.sort(fpos_scores)
+        fpos = (np.searchsorted(checked, thresholds) -
+                np.searchsorted(fpos_scores, thresholds))
+        for idx_th in range(len(thresholds)):
+            stats[idx_th][idx_at]['tpos'] += int(tpos[idx_th])
+            stats[idx_th][idx_at]['fneg'] += int(n_refs - tpos[idx_th])
+            stats[idx_th][idx_at]['fpos'] += fpos[idx_th]
+
+    return stats
+
+
+def _get_nnz_at_thresholds(sims, thresholds):
+    data = sims.data if scipy.sparse.issparse(sims) else np.asarray(sims).ravel()
+    data = np.sort(data[data != 0])
+    return (len(data) - np.searchsorted(data, thresholds)).tolist()
+
+
+def get_thresholded_metrics(sims, refs, thresholds, copy=False,
+                            at_values=(1, 5, 10, 20), strict=False):
+    """
+    Get metrics from similarity metric and refs for each threshold in
+    `thresholds`. The ranking is only computed once (see
+    `ranking_stats_from_thresholds`), and the input similarities are never
+    modified (`copy` is kept for backwards compatibility).
+    """
+    ranking, scores = sparse_utils.top_k(sims, max(at_values))
+    stats = ranking_stats_from_thresholds(
+        ranking, scores, refs, thresholds, at_values=at_values, strict=strict)
+
+    metrics = collections.defaultdict(list)
+    for th_stats in stats:
+        for metric, val in _get_metrics_from_stats(th_stats, at_values).items():
             metrics[metric].append(val)
-        metrics['nnz'].append(sims.nnz)
+    metrics['nnz'] = _get_nnz_at_thresholds(sims, thresholds)
 
     return metrics
 
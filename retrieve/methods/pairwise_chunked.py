@@ -1,37 +1,96 @@
 
+import functools
+import logging
+
 import tqdm
 import scipy.sparse
 from sklearn.metrics.pairwise import pairwise_kernels
 
-from ..sparse_utils import sparse_chunks, set_threshold
+from ..sparse_utils import set_threshold, top_k_csr
+from ..sparse_utils import SparseAccumulator, sparse_linear_kernel
+from .sharded import imap_chunks
+
+
+logger = logging.getLogger(__name__)
+
+# default number of query rows per chunk in top_k mode
+TOP_K_CHUNK_SIZE = 1000
+
+
+def _use_sparse_kernel(X, Y, metric, threshold, top_k):
+    # the sparse kernel is only worth it if the output is meant to be sparse
+    return metric == 'linear' and (threshold > 0 or top_k > 0) and \
+        scipy.sparse.issparse(X) and scipy.sparse.issparse(Y)
+
+
+def _pairwise_kernels_chunk(Q, Y, metric='linear', threshold=0, top_k=0, n_jobs=-1,
+                            parallel=True):
+    if _use_sparse_kernel(Q, Y, metric, threshold, top_k):
+        # threshold and top_k are applied inside the sparse kernel
+        return sparse_linear_kernel(
+            Q, Y, threshold=threshold, top_k=top_k, parallel=parallel)
+
+    Q_sims = pairwise_kernels(Q, Y, metric=metric, n_jobs=n_jobs)
+    if top_k > 0:
+        Q_sims = top_k_csr(Q_sims, top_k, threshold=threshold, parallel=parallel)
+    elif threshold > 0:
+        Q_sims = set_threshold(Q_sims, threshold)
+    return Q_sims
 
 
 def pairwise_kernels_chunked(X, Y=None, metric='linear', chunk_size=0,
-                             desc=None, disable_bar=True, threshold=0, n_jobs=-1):
+                             desc=None, disable_bar=True, threshold=0, top_k=0,
+                             n_jobs=-1, processes=1):
     """
     Chunked version of pairwise_kernels that applies thresholds to produce
     sparse similarity matrices
+
+    Arguments
+    =========
+
+    top_k : int (optional), if greater than 0, only the `top_k` most similar
+        items per row in `X` are kept. Each chunk is reduced as soon as it is
+        computed, so that the output (CSR) only requires memory proportional
+        to n * top_k (plus one dense block of chunk_size x m). If `chunk_size`
+        isn't positive, chunks of `TOP_K_CHUNK_SIZE` rows are used
+
+    processes : int (optional), if different from 1, chunks are processed in
+        parallel by a pool of `processes` workers (-1 uses all cpus) that access
+        X and Y through shared memory. Only used in chunked mode (`chunk_size`
+        > 0 or `top_k` > 0), otherwise the full matrix is computed in the
+        current process (with `n_jobs` threads) and a warning is logged.
+
+    If both X and Y are sparse, the metric is "linear" (e.g. the normalized
+    output of `Tfidf` or `BOW`) and a positive `threshold` or `top_k` is given,
+    similarities are computed with a sparse kernel over the inverted postings
+    of Y, which applies the threshold and top_k without a dense intermediate.
     """
     if Y is None:
         Y = X
 
-    if chunk_size > 0:
-        (n, _), (m, _) = X.shape, Y.shape
-        sims = scipy.sparse.lil_matrix((n, m))
-        n_chunks = n // chunk_size
-        for (i_start, i_stop), Q in tqdm.tqdm(sparse_chunks(X, chunk_size),
-                                              total=n_chunks, desc=desc,
-                                              disable=disable_bar):
-            Q_sims = pairwise_kernels(Q, Y, metric=metric, n_jobs=-1)
-            if threshold > 0:
-                Q_sims = set_threshold(Q_sims, threshold)
-                sims[i_start: i_stop, :] = Q_sims
-    else:
-        sims = pairwise_kernels(X, Y, metric=metric, n_jobs=n_jobs)
-        if threshold > 0.0:
-            sims = set_threshold(sims, threshold)
-
-    if scipy.sparse.isspmatrix_lil(sims):
-        sims = sims.tocsr()
-
-    return sims
+    if _use_sparse_kernel(X, Y, metric, threshold, top_k):
+        # inverted index over Y, only computed once for all chunks
+        Y = Y.tocsc()
+
+    if chunk_size <= 0 and top_k <= 0:
+        if processes != 1:
+            logger.warning("Ignoring processes={} since chunk_size <= 0".format(
+                processes))
+        return _pairwise_kernels_chunk(
+            X, Y, metric=metric, threshold=threshold, n_jobs=n_jobs)
+
+    (n, _), (m, _) = X.shape, Y.shape
+    # bound the size of the dense intermediate blocks if no chunk_size was given
+    chunk_size = chunk_size if chunk_size > 0 else TOP_K_CHUNK_SIZE
+    # avoid oversubscription when running in parallel
+    fn = functools.partial(
+        _pairwise_kernels_chunk, metric=metric, threshold=threshold, top_k=top_k,
+        n_jobs=n_jobs if processes == 1 else 1, parallel=processes == 1)
+    sims = SparseAccumulator((n, m))
+    for (i_start, _), Q_sims in tqdm.tqdm(
+            imap_chunks(fn, X, chunk_size, processes=processes, shared={'Y': Y}),
+            total=-(-n // chunk_size), desc=desc, disable=disable_bar):
+        sims.add_chunk(i_start, Q_sims)
+
+    return sims.tocsr()
+
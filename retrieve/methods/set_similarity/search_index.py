@@ -4,8 +4,10 @@ Modification from https://github.com/ekzhu/SetSimilaritySearch
 LICENSE: https://raw.githubusercontent.com/ekzhu/SetSimilaritySearch/master/LICENSE
 """
 
+import os
+import json
 import logging
-from collections import defaultdict, deque
+from collections import deque
 
 import numpy as np
 
@@ -17,14 +19,27 @@ from SetSimilaritySearch.utils import _frequency_order_transform, \
 logger = logging.getLogger(__name__)
 
 
+# arrays holding the index, stored as `<name>.npy` by `SearchIndex.save`
+_ARRAYS = ('set_indptr', 'set_tokens', 'postings_indptr', 'postings_sets',
+           'postings_pos')
+
+
 class SearchIndex(object):
     """This data structure supports set similarity search queries.
     The algorithm is a combination of the prefix filter and position filter
     techniques.
 
+    The index is stored in flat arrays: the frequency-ordered sets are
+    concatenated in `set_tokens` (with offsets in `set_indptr`) and the
+    prefix postings of each token are stored in `postings_sets` and
+    `postings_pos` (with offsets in `postings_indptr`). The index can be
+    saved to a directory and loaded back as memory-mapped arrays.
+
     Args:
         sets (list): a list of sets, each entry is an iterable representing a
             set.
+        queries (list): optional list of query sets. Their tokens are taken
+            into account for the frequency order, but they aren't indexed.
         similarity_func_name (str): the name of the similarity function used;
             this function currently supports `"jaccard"`, `"cosine"`, and
             `"containment"`.
@@ -36,12 +51,28 @@ class SearchIndex(object):
                  similarity_threshold=0.5):
         if not isinstance(index, list) or len(index) == 0:
             raise ValueError("Input parameter sets must be a non-empty list.")
+        self._set_similarity_func(similarity_func_name, similarity_threshold)
+        logger.debug("Building SearchIndex on {} sets.".format(len(index)))
+        logger.debug("Start frequency transform.")
+        sets, order = _frequency_order_transform(index + (queries or []))
+        self.n_sets = len(index)
+        self.tokens = list(order)
+        self.order = order
+        logger.debug("Finish frequency transform, {} tokens in total.".format(
+            len(self.order)))
+        logger.debug("Start indexing sets.")
+        self._build_index(sets[:self.n_sets])
+        logger.debug("Finished indexing sets.")
+        self.path = self.mmap_mode = None
+
+    def _set_similarity_func(self, similarity_func_name, similarity_threshold):
         if similarity_func_name not in _similarity_funcs:
             raise ValueError("Similarity function {} is not supported.".format(
                 similarity_func_name))
         if similarity_threshold < 0 or similarity_threshold > 1.0:
             raise ValueError(
                 "Similarity threshold must be in the range [0, 1].")
+        self.similarity_func_name = similarity_func_name
         self.similarity_threshold = similarity_threshold
         self.similarity_func = _similarity_funcs[similarity_func_name]
         self.overlap_threshold_func = \
@@ -49,29 +80,91 @@ class SearchIndex(object):
         self.overlap_index_threshold_func = \
             _overlap_index_threshold_funcs[similarity_func_name]
         self.position_filter_func = _position_filter_funcs[similarity_func_name]
-        logger.debug("Building SearchIndex on {} sets.".format(len(index)))
-        logger.debug("Start frequency transform.")
-        self.sets, self.order = _frequency_order_transform(index + (queries or []))
-        self.n_sets = len(index)
-        logger.debug("Finish frequency transform, {} tokens in total.".format(
-            len(self.order)))
-        self.index = defaultdict(list)
-        logger.debug("Start indexing sets.")
-        for i, s in enumerate(self.sets):
-            prefix = self._get_prefix_index(s)
-            for j, token in enumerate(prefix):
-                self.index[token].append((i, j))
-        logger.debug("Finished indexing sets.")
 
-    def _get_prefix_index(self, s):
-        t = self.overlap_index_threshold_func(len(s), self.similarity_threshold)
-        prefix_size = len(s) - t + 1
-        return s[:prefix_size]
+    def _build_index(self, sets):
+        lengths = np.array([len(s) for s in sets], dtype=np.int64)
+        self.set_indptr = np.zeros(len(sets) + 1, dtype=np.int64)
+        self.set_indptr[1:] = np.cumsum(lengths)
+        self.set_tokens = np.concatenate(
+            [np.asarray(s, dtype=np.int32) for s in sets]).astype(np.int32)
+
+        # prefix of each set (positions relative to the start of the set)
+        prefix_sizes = np.array(
+            [self._get_prefix_size(length, self.overlap_index_threshold_func)
+             for length in lengths.tolist()], dtype=np.int64)
+        set_ids = np.repeat(np.arange(len(sets), dtype=np.int32), prefix_sizes)
+        positions = np.arange(prefix_sizes.sum()) - np.repeat(
+            np.cumsum(prefix_sizes) - prefix_sizes, prefix_sizes)
+        tokens = self.set_tokens[self.set_indptr[set_ids] + positions]
+
+        # group postings by token (keeping the set order within each token)
+        order = np.argsort(tokens, kind='stable')
+        self.postings_sets = set_ids[order]
+        self.postings_pos = positions[order].astype(np.int32)
+        self.postings_indptr = np.zeros(len(self.tokens) + 1, dtype=np.int64)
+        self.postings_indptr[1:] = np.cumsum(
+            np.bincount(tokens, minlength=len(self.tokens)))
+
+    def save(self, path):
+        """Save the index to directory `path` (created if it doesn't exist),
+        storing each array as a `.npy` file so that it can be memory-mapped
+        by `SearchIndex.load`. The tokens are stored as JSON, so they must be
+        strings (or numbers).
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'similarity_func_name': self.similarity_func_name,
+                       'similarity_threshold': self.similarity_threshold,
+                       'n_sets': self.n_sets,
+                       'tokens': self.tokens}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load an index saved with `SearchIndex.save`. By default, the arrays
+        are memory-mapped, so that loading is fast and processes querying the
+        same index share the pages.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        search_index = cls.__new__(cls)
+        search_index._set_similarity_func(
+            meta['similarity_func_name'], meta['similarity_threshold'])
+        search_index.n_sets = meta['n_sets']
+        search_index.tokens = meta['tokens']
+        search_index.order = {token: i for i, token in enumerate(meta['tokens'])}
+        for name in _ARRAYS:
+            setattr(search_index, name, np.load(
+                os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        search_index.path, search_index.mmap_mode = path, mmap_mode
+        return search_index
+
+    def __getstate__(self):
+        # memory-mapped indices are reloaded from disk instead of being pickled
+        if self.path is not None and self.mmap_mode is not None:
+            return {'path': self.path, 'mmap_mode': self.mmap_mode}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'tokens' not in state:
+            state = SearchIndex.load(state['path'], state['mmap_mode']).__dict__
+        self.__dict__.update(state)
 
-    def _get_prefix(self, s):
-        t = self.overlap_threshold_func(len(s), self.similarity_threshold)
-        prefix_size = len(s) - t + 1
-        return s[:prefix_size]
+    def _get_prefix_size(self, length, threshold_func):
+        t = threshold_func(length, self.similarity_threshold)
+        return min(max(length - t + 1, 0), length)
+
+    def _get_set(self, i):
+        return self.set_tokens[self.set_indptr[i]:self.set_indptr[i + 1]]
+
+    def _encode(self, s):
+        # tokens missing from the index are mapped to distinct negative ids,
+        # so that they still count towards the size of the query set
+        known = [self.order[token] for token in s if token in self.order]
+        n_missing = len(s) - len(known)
+        return np.sort(np.array(
+            known + list(range(-n_missing, 0)), dtype=np.int64))
 
     def query(self, s):
         """Query the search index for sets similar to the query set.
@@ -82,19 +175,24 @@ class SearchIndex(object):
         Returns (list): a list of tuples `(index, similarity)` where the index
             is the index of the matching sets in the original list of sets.
         """
-        s1 = np.sort([self.order[token] for token in s if token in self.order])
+        s1 = self._encode(s)
         logger.debug("{} original tokens and {} tokens after applying "
                      "frequency order.".format(len(s), len(s1)))
-        prefix = self._get_prefix(s1)
-        candidates = set([i for p1, token in enumerate(prefix)
-                          for i, p2 in self.index[token]
-                          if (i < self.n_sets and self.position_filter_func(
-                              s1, self.sets[i], p1, p2,
-                              self.similarity_threshold))])
+        prefix = s1[:self._get_prefix_size(len(s1), self.overlap_threshold_func)]
+        candidates = set()
+        for p1, token in enumerate(prefix.tolist()):
+            if token < 0:
+                continue
+            start, stop = self.postings_indptr[token], self.postings_indptr[token + 1]
+            for i, p2 in zip(self.postings_sets[start:stop].tolist(),
+                             self.postings_pos[start:stop].tolist()):
+                if self.position_filter_func(
+                        s1, self._get_set(i), p1, p2, self.similarity_threshold):
+                    candidates.add(i)
         logger.debug("{} candidates found.".format(len(candidates)))
         results = deque([])
         for i in candidates:
-            s2 = self.sets[i]
+            s2 = self._get_set(i)
             sim = self.similarity_func(s1, s2)
             if sim < self.similarity_threshold:
                 continue
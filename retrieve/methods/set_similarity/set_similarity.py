@@ -1,12 +1,14 @@
 
 
 import logging
+import tempfile
 import multiprocessing as mp
 
 from scipy.sparse import dok_matrix
 from tqdm import tqdm
 
 from .search_index import SearchIndex
+from ..sharded import _get_context
 
 logger = logging.getLogger(__name__)
 
@@ -59,13 +61,18 @@ class Workload:
 
 
 def parallel_search(search_index, queries, processes):
-    workload = Workload(search_index, queries)
-
     sims = {}
-    with mp.Pool(processes) as pool:
-        for i, candidates in pool.map(workload, list(range(len(queries)))):
-            for j, sim in candidates:
-                sims[i, j] = sim
+    with tempfile.TemporaryDirectory() as path:
+        if search_index.path is None or search_index.mmap_mode is None:
+            # share the index through memory-mapped files instead of sending
+            # a pickled copy to each worker
+            search_index.save(path)
+            search_index = SearchIndex.load(path)
+        workload = Workload(search_index, queries)
+        with _get_context().Pool(processes) as pool:
+            for i, candidates in pool.map(workload, list(range(len(queries)))):
+                for j, sim in candidates:
+                    sims[i, j] = sim
 
     return sims
 
@@ -75,6 +82,10 @@ class SetSimilarity:
     Approximate set similarity
 
     similarity_fn : one of ...
+
+    The search index can be fitted once (see `fit`) and reused across calls
+    to `get_similarities` with `refit=False`, and it can be saved to and
+    loaded from disk (see `save` and `load`).
     """
     def __init__(self, threshold, similarity_fn='containment'):
         self.threshold = threshold
@@ -88,14 +99,47 @@ class SetSimilarity:
             similarity_threshold=self.threshold)
         return self
 
-    def get_similarities(self, queries, index=None, processes=1):
-        self_search = index is None
-        if index is None:
-            index = queries
-
-        self.fit(index, queries=queries)
+    def save(self, path):
+        """
+        Save the fitted search index to directory `path`
+        """
+        if self.search_index is None:
+            raise ValueError("SetSimilarity hasn't been fitted")
+        self.search_index.save(path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Load a SetSimilarity instance from a search index saved with `save`
+        """
+        search_index = SearchIndex.load(path, mmap_mode=mmap_mode)
+        sim = cls(search_index.similarity_threshold, search_index.similarity_func_name)
+        sim.search_index = search_index
+        return sim
+
+    def get_similarities(self, queries, index=None, processes=1, refit=True):
+        """
+        Arguments
+        =========
+        queries : list of sets
+        index : list of sets (optional), if not given, the similarities between
+            the queries are computed (excluding self-similarities)
+        processes : int, number of processes
+        refit : bool, if False, `index` is ignored and the queries are run
+            against the already fitted (or loaded) search index
+        """
+        if not refit:
+            if self.search_index is None:
+                raise ValueError("SetSimilarity hasn't been fitted")
+            self_search, n_index = False, self.search_index.n_sets
+        else:
+            self_search = index is None
+            if index is None:
+                index = queries
+            self.fit(index, queries=queries)
+            n_index = len(index)
 
-        sims = dok_matrix((len(queries), len(index)))
+        sims = dok_matrix((len(queries), n_index))
 
         processes = mp.cpu_count() if processes < 0 else processes
         logger.info("Using {} cpus".format(processes))
@@ -0,0 +1,152 @@
+
+import logging
+import multiprocessing as mp
+import multiprocessing.util
+from multiprocessing import shared_memory
+
+import numpy as np
+import scipy.sparse
+
+from ..sparse_utils import sparse_chunks
+
+
+logger = logging.getLogger(__name__)
+
+# state of the worker processes, populated by `_init_worker`
+_WORKER = {}
+
+
+def _share_array(X, blocks):
+    X = np.ascontiguousarray(X)
+    block = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    np.ndarray(X.shape, dtype=X.dtype, buffer=block.buf)[...] = X
+    blocks.append(block)
+    return block.name, X.shape, X.dtype.str
+
+
+def _attach_array(name, shape, dtype, blocks):
+    # the parent process owns (and unlinks) the block
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def share_matrix(X, blocks):
+    """
+    Copy a dense, CSR or CSC matrix into shared memory blocks (appended to `blocks`)
+    and return a picklable descriptor that can be passed to `attach_matrix`
+    """
+    if scipy.sparse.issparse(X):
+        X = X if scipy.sparse.isspmatrix_csc(X) else X.tocsr()
+        return {'format': X.format, 'shape': X.shape,
+                'arrays': {key: _share_array(getattr(X, key), blocks)
+                           for key in ['data', 'indices', 'indptr']}}
+
+    return {'format': 'dense', 'shape': X.shape,
+            'arrays': {'data': _share_array(np.asarray(X), blocks)}}
+
+
+def attach_matrix(descriptor, blocks):
+    """
+    Rebuild a matrix created with `share_matrix` on top of the shared memory
+    blocks without copying the data
+    """
+    arrays = {key: _attach_array(*args, blocks)
+              for key, args in descriptor['arrays'].items()}
+    if descriptor['format'] in ('csr', 'csc'):
+        matrix = getattr(scipy.sparse, descriptor['format'] + '_matrix')
+        return matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                      shape=descriptor['shape'], copy=False)
+
+    return arrays['data']
+
+
+def _get_context():
+    # numba's threading layers are not fork-safe, so workers are forked from a
+    # clean server process (which imports `retrieve` only once) instead of
+    # from the parent process
+    try:
+        ctx = mp.get_context('forkserver')
+        ctx.set_forkserver_preload(['retrieve.methods'])
+    except ValueError:
+        ctx = mp.get_context('spawn')
+    return ctx
+
+
+def _close_worker():
+    # drop the views on the shared buffers before closing them
+    _WORKER.pop('shared', None)
+    for block in _WORKER.pop('blocks', []):
+        block.close()
+
+
+def _init_worker(fn, descriptors):
+    # the attached blocks are closed (but not unlinked) when the worker exits
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+    _WORKER['fn'] = fn
+    _WORKER['blocks'] = []
+    _WORKER['shared'] = {key: attach_matrix(descriptor, _WORKER['blocks'])
+                         for key, descriptor in descriptors.items()}
+
+
+def _process_chunk(chunk):
+    i_start, i_stop = chunk
+    shared = dict(_WORKER['shared'])
+    Q = shared.pop('_X')[i_start:i_stop]
+    return (i_start, i_stop), _WORKER['fn'](Q, **shared)
+
+
+def imap_chunks(fn, X, chunk_size, processes=1, shared=None):
+    """
+    Apply `fn` to consecutive chunks of rows of X, yielding the results in
+    order as tuples ((i_start, i_stop), fn(X[i_start:i_stop], **shared)).
+
+    If `processes` is different from 1 (-1 uses all cpus), the chunks are
+    dispatched to a process pool. In that case, X and the matrices in `shared`
+    are placed in shared memory once, and workers only receive row ranges, so
+    that large inputs (e.g. the index or the word-similarity matrix) are never
+    pickled. `fn` must be picklable (a top level function or a partial of it).
+
+    Arguments
+    =========
+
+    fn : function taking a chunk of X and the keyword arguments in `shared`
+    X : np.array or scipy.sparse matrix (n x ...)
+    chunk_size : int, number of rows per chunk
+    processes : int, number of processes
+    shared : dict (optional), mapping argument names of `fn` to dense or sparse
+        matrices that should be shared with the workers
+
+    >>> X = np.arange(10).reshape(5, 2)
+    >>> for (i_start, i_stop), out in imap_chunks(np.sum, X, 2):
+    ...     print(i_start, i_stop, out)
+    0 2 6
+    2 4 22
+    4 5 17
+    """
+    shared = shared or {}
+
+    if processes == 1:
+        for (i_start, i_stop), Q in sparse_chunks(X, chunk_size):
+            yield (i_start, i_stop), fn(Q, **shared)
+        return
+
+    processes = mp.cpu_count() if processes < 0 else processes
+    logger.info("Using {} cpus".format(processes))
+    n, *_ = X.shape
+    chunks = [(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+
+    blocks = []
+    try:
+        descriptors = {key: share_matrix(M, blocks) for key, M in shared.items()}
+        descriptors['_X'] = share_matrix(X, blocks)
+        with _get_context().Pool(processes, initializer=_init_worker,
+                                 initargs=(fn, descriptors)) as pool:
+            yield from pool.imap(_process_chunk, chunks)
+            # let the workers exit cleanly so that they release their blocks
+            pool.close()
+            pool.join()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
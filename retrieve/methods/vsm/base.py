@@ -30,7 +30,8 @@ class VSM:
 
     def get_similarities(self, queries, index,
                          threshold=0.25, metric='linear',
-                         chunk_size=-1, disable_bar=False, **kwargs):
+                         chunk_size=-1, top_k=0, processes=1, disable_bar=False,
+                         **kwargs):
         """
         Get similarities according to specified kernel.
 
@@ -38,7 +39,9 @@ class VSM:
         =========
 
         threshold : float (optional), discard similarities below threshold,
-            helps enforcing sparsity of the resulting matrix
+            helps enforcing sparsity of the resulting matrix. If positive, the
+            output is a thresholded CSR matrix (set it to 0 to get the full
+            dense similarity matrix)
 
         metric : str, (optional), default is "linear" which corresponds to
             a cosine similarity since all `retrieve` vectorizers output
@@ -48,6 +51,13 @@ class VSM:
             be partitioned in chunk of `chunk_size` items and processed in batches.
             In combination with a certain `threshold`, this will allow to fit
             the whole (sparse) similarity matrix in memory
+
+        top_k : int, (optional), if greater than 0, only the `top_k` most similar
+            index items are kept for each query, which keeps the memory of the
+            output proportional to the number of queries
+
+        processes : int, (optional), number of processes used to compute the
+            chunks in parallel (-1 uses all cpus), requires `chunk_size` > 0
         """
         from retrieve.methods import pairwise_kernels_chunked
 
@@ -57,6 +67,7 @@ class VSM:
 
         sims = pairwise_kernels_chunked(
             queries, index, metric=metric, chunk_size=chunk_size,
+            threshold=threshold, top_k=top_k, processes=processes,
             desc='Chunked similarities', disable_bar=disable_bar)
 
         return sims
@@ -67,7 +78,8 @@ class VSMSoftCosine(VSM):
         self.vectorizer = init_sklearn_vectorizer(vectorizer, vocab=vocab, **kwargs)
 
     def get_soft_cosine_similarities(self, queries, index, embs, threshold=0.25,
-                                     chunk_size=500, disable_bar=False, **kwargs):
+                                     chunk_size=500, processes=1, disable_bar=False,
+                                     **kwargs):
         """
         Compute soft cosine similarities between queries and index using the
         (possibly sparse) similarity matrix S indexing the similarity between
@@ -84,6 +96,9 @@ class VSMSoftCosine(VSM):
             In combination with a certain `threshold`, this will allow to fit
             the whole (sparse) similarity matrix in memory
 
+        processes : int, (optional), number of processes used to compute the
+            chunks in parallel (-1 uses all cpus)
+
         kwargs : extra arguments passed to embs.get_S
         """
         index, queries = list(index), list(queries)
@@ -93,6 +108,6 @@ class VSMSoftCosine(VSM):
             words=self.vectorizer.get_feature_names(), fill_missing=True, **kwargs)
         sims = soft_cosine_similarities(
             queries, index, S, chunk_size=chunk_size, threshold=threshold,
-            disable_bar=disable_bar)
+            processes=processes, disable_bar=disable_bar)
 
         return sims
@@ -1,12 +1,14 @@
 
 import math
+import functools
 
 import numpy as np
 import scipy.sparse
 
 import tqdm
 
-from ...sparse_utils import sparse_chunks, set_threshold
+from ...sparse_utils import set_threshold, SparseAccumulator
+from ..sharded import imap_chunks
 
 
 def soft_cosine_simple(query, index, S):
@@ -29,8 +31,33 @@ def soft_cosine_simple(query, index, S):
     return (num / (math.sqrt(den1) * math.sqrt(den2)))
 
 
+def _soft_cosine_chunk(Q, S, SindexT, den2, threshold=0.0):
+    # (chunk_size x vocab) @ (vocab x m) -> (chunk_size x m)
+    num = Q @ SindexT
+
+    # (vocab x vocab) x (vocab x chunk_size) -> (vocab x chunk_size)
+    SqueryT = S @ Q.T
+    # (chunk_size x vocab) x (chunk_size x vocab) -> (chunk_size x vocab)
+    den1 = Q.multiply(SqueryT.T)
+    # (chunk_size x vocab) -> (chunk_size)
+    den1 = np.asarray(den1.sum(1)).ravel()
+    den1 = np.sqrt(den1)
+
+    # (chunk_size x m)
+    Q_sims = (den1[:, None] * den2[None, :])
+    Q_sims = num.multiply(1 / Q_sims) if scipy.sparse.issparse(S) else (num / Q_sims)
+
+    # apply threshold
+    if scipy.sparse.issparse(Q_sims):
+        Q_sims = set_threshold(Q_sims, threshold)
+    else:
+        Q_sims[Q_sims < threshold] = 0.0
+
+    return Q_sims
+
+
 def soft_cosine_similarities(queries, index, S, chunk_size=500, threshold=0.0,
-                             disable_bar=False):
+                             disable_bar=False, processes=1):
     """
     This function assumes that the order of vocabulary in the similarity matrix
     correspondes to the order of the vocabulary in the document representations
@@ -41,49 +68,41 @@ def soft_cosine_similarities(queries, index, S, chunk_size=500, threshold=0.0,
     queries : np.array(n, vocab), n query docs in BOW format
     index : np.array(m, vocab), m indexed docs in BOW format
     S : np.array(vocab, vocab), similarity matrix (possibly raised to a power)
+    processes : int (optional), if different from 1, query chunks are processed
+        in parallel by a pool of `processes` workers (-1 uses all cpus), which
+        access S and the transformed index through shared memory
 
     Output
     ======
     sims : np.array(n, m), soft cosine similarities
     """
     is_S_sparse = scipy.sparse.issparse(S)
-    n_chunks = queries.shape[0] // chunk_size
+    n_chunks = -(-queries.shape[0] // chunk_size)
 
     (n, _), (m, _) = queries.shape, index.shape
-    sims = scipy.sparse.lil_matrix((n, m)) if is_S_sparse else np.zeros((n, m))
+    sims = SparseAccumulator((n, m)) if is_S_sparse else np.zeros((n, m))
 
     # (vocab x m) assumes m << n, so this can be stored in memory
     SindexT = S @ index.T
     # (m x vocab) x (m x vocab) -> (m x vocab)
     den2 = index.multiply(SindexT.T)
     # (m x vocab) -> (m)
-    den2 = np.squeeze(np.array(den2.sum(1)))
+    den2 = np.asarray(den2.sum(1)).ravel()
     den2 = np.sqrt(den2)
 
-    for (i_start, i_stop), Q in tqdm.tqdm(sparse_chunks(queries, chunk_size),
-                                          total=n_chunks, desc='Soft cosine',
-                                          disable=disable_bar):
-        # (chunk_size x vocab) @ (vocab x m) -> (chunk_size x m)
-        num = Q @ SindexT
-
-        # (vocab x vocab) x (vocab x chunk_size) -> (vocab x chunk_size)
-        SqueryT = S @ Q.T
-        # (chunk_size x vocab) x (chunk_size x vocab) -> (chunk_size x vocab)
-        den1 = Q.multiply(SqueryT.T)
-        # (chunk_size x vocab) -> (chunk_size)
-        den1 = np.squeeze(np.array(den1.sum(1)))
-        den1 = np.sqrt(den1)
-
-        # (chunk_size x m)
-        Q_sims = (den1[:, None] * den2[None, :])
-        Q_sims = num.multiply(1 / Q_sims) if is_S_sparse else (num / Q_sims)
-
-        # apply threshold
-        set_threshold(Q_sims, threshold)
+    chunks = imap_chunks(
+        functools.partial(_soft_cosine_chunk, threshold=threshold),
+        queries, chunk_size, processes=processes,
+        shared={'S': S, 'SindexT': SindexT, 'den2': den2})
 
-        sims[i_start:i_stop, :] = Q_sims
+    for (i_start, i_stop), Q_sims in tqdm.tqdm(
+            chunks, total=n_chunks, desc='Soft cosine', disable=disable_bar):
+        if is_S_sparse:
+            sims.add_chunk(i_start, Q_sims)
+        else:
+            sims[i_start:i_stop, :] = Q_sims
 
-    if scipy.sparse.isspmatrix_lil(sims):
+    if is_S_sparse:
         sims = sims.tocsr()
 
     return np.nan_to_num(sims, copy=False)
@@ -5,71 +5,102 @@ import numba as nb
 
 
 @nb.njit()
-def _top_k_dense(data, indices, indptr, k):
+def _select_top_k(values, k, selected):
+    # write the positions of the (at most) k highest values to `selected`, in
+    # descending order, and return how many were selected. Instead of sorting
+    # all values, the k-th highest value is found with a partial partition and
+    # only the items above it are sorted
+    n = len(values)
+    if n > k:
+        kth = -np.partition(-values, k - 1)[k - 1]
+        n_items = 0
+        for t in range(n):
+            if values[t] > kth:
+                selected[n_items] = t
+                n_items += 1
+        # fill up with ties
+        for t in range(n):
+            if n_items == k:
+                break
+            if values[t] == kth:
+                selected[n_items] = t
+                n_items += 1
+    else:
+        n_items = n
+        for t in range(n):
+            selected[t] = t
+    items = selected[:n_items]
+    order = np.argsort(-values[items], kind='mergesort')
+    selected[:n_items] = items[order]
+    return n_items
+
+
+@nb.njit(parallel=True)
+def _top_k_sparse_rows(data, indices, indptr, k):
     # indptr holds pointers to indices and data
     # indices[indptr[0]:indptr[1]] -> index of nonzero items in 1st row
     # data[indptr[0]:indptr[1]]    -> nonzero items in 1st row
     nrows = indptr.shape[0] - 1  # substract one because of format
 
     # output variables
-    top_indices = np.zeros((nrows, k), dtype=indices.dtype) - 1
+    top_indices = np.zeros((nrows, k), dtype=np.int64) - 1
     top_data = np.zeros((nrows, k), dtype=data.dtype) * np.nan
 
     for i in nb.prange(nrows):
         start, stop = indptr[i], indptr[i + 1]
-        top_k = np.argsort(data[start:stop])[::-1][:k]
-        n_items = min(len(top_k), k)
-        # assign
-        top_indices[i, 0:n_items] = indices[start:stop][top_k]
-        top_data[i, 0:n_items] = data[start:stop][top_k]
+        selected = np.empty(stop - start, dtype=np.int64)
+        n_items = _select_top_k(data[start:stop], k, selected)
+        for t in range(n_items):
+            top_indices[i, t] = indices[start + selected[t]]
+            top_data[i, t] = data[start + selected[t]]
 
     return top_indices, top_data
 
 
-@nb.njit()
-def _top_k_sparse_data(data, indices, indptr, k):
-    # indptr holds pointers to indices and data
-    # indices[indptr[0]:indptr[1]] -> index of nonzero items in 1st row
-    # data[indptr[0]:indptr[1]]    -> nonzero items in 1st row
-    nrows = indptr.shape[0] - 1  # substract one because of format
+@nb.njit(parallel=True)
+def _top_k_dense_rows(X, k):
+    nrows, ncols = X.shape
 
-    top_indices = []
-    top_vals = []
-    top_rows = []
-    top_cols = []
+    top_indices = np.zeros((nrows, k), dtype=np.int64) - 1
+    top_data = np.zeros((nrows, k), dtype=X.dtype) * np.nan
 
     for i in nb.prange(nrows):
-        start, stop = indptr[i], indptr[i + 1]
-        top_k = np.argsort(data[start:stop])[::-1][:k]
-        if len(top_k) > 0:
-            top_indices.append(indices[start:stop][top_k])
-            top_vals.append(data[start:stop][top_k])
-            top_cols.append(np.arange(0, len(top_k)))
-            top_rows.append(np.repeat([i], len(top_k)))
-
-    return top_indices, top_vals, top_rows, top_cols
+        # only consider nonzero items, as in the sparse case
+        cols = np.flatnonzero(X[i])
+        selected = np.empty(len(cols), dtype=np.int64)
+        n_items = _select_top_k(X[i][cols], k, selected)
+        for t in range(n_items):
+            top_indices[i, t] = cols[selected[t]]
+            top_data[i, t] = X[i, cols[selected[t]]]
 
+    return top_indices, top_data
 
-def _top_k_sparse(data, indices, indptr, k):
-    top_idxs, top_vals, rows, cols = _top_k_sparse_data(data, indices, indptr, k)
-    top_idxs, top_vals = np.concatenate(top_idxs), np.concatenate(top_vals)
-    rows, cols = np.concatenate(rows), np.concatenate(cols)
-    top_idxs = scipy.sparse.csr_matrix((top_idxs, (rows, cols)), dtype=indices.dtype)
-    top_vals = scipy.sparse.csr_matrix((top_vals, (rows, cols)), dtype=data.dtype)
 
-    return top_idxs, top_vals
+# serial versions, used when the caller already runs in parallel processes
+_top_k_sparse_rows_serial = nb.njit(cache=True)(_top_k_sparse_rows.py_func)
+_top_k_dense_rows_serial = nb.njit(cache=True)(_top_k_dense_rows.py_func)
 
 
-def top_k(X, k):
+def top_k(X, k, parallel=True):
     """
+    Select the top k items per row of a dense or sparse matrix. Rows are
+    processed in parallel and only partially sorted. Zero entries (which
+    in sparse input are not stored) are never selected, so that dense and
+    sparse input produce the same output.
+
+    Arguments
+    =========
     X : matrix, (n x m)
+    k : int
+    parallel : bool, whether to use multiple threads
 
     Output
     ======
 
-    np.array(n x k), top_k items per row, it doesn't exclude the
-        highest one, which is in self-search typically corresponds
-        to itself
+    (indices, data) : tuple of np.array(n x k), top_k items per row (and their
+        values) in descending order. It doesn't exclude the highest one, which
+        is in self-search typically corresponds to itself. Rows with less than
+        k nonzero items are padded with -1 (indices) and nan (data).
 
     >>> # checkerboard pattern with rowise increments
     >>> nrow = 3
@@ -83,13 +114,208 @@ def top_k(X, k):
     [[4, 2], [3, 1], [4, 2]]
     >>> data.tolist()
     [[3.0, 2.0], [5.0, 4.0], [8.0, 7.0]]
+    >>> dense_indices, dense_data = top_k(X.toarray(), 2)
+    >>> np.array_equal(indices, dense_indices), np.array_equal(data, dense_data)
+    (True, True)
+    >>> top_k(X, 3)[0].tolist()
+    [[4, 2, 0], [3, 1, -1], [4, 2, 0]]
     """
-    if not scipy.sparse.issparse(X):
-        return np.argsort(X, 1)[::-1][:, :k]
+    if scipy.sparse.issparse(X):
+        X = X.tocsr()
+        fn = _top_k_sparse_rows if parallel else _top_k_sparse_rows_serial
+        return fn(X.data.astype(np.float64, copy=False), X.indices, X.indptr, k)
+
+    fn = _top_k_dense_rows if parallel else _top_k_dense_rows_serial
+    return fn(np.ascontiguousarray(X, dtype=np.float64), k)
+
+
+def top_k_csr(X, k, threshold=0.0, parallel=True):
+    """
+    Keep only the `k` highest entries per row of a (possibly sparse) matrix
+    and return them as a CSR matrix of the same shape. Entries below
+    `threshold` (and zero entries) are dropped as well. See `top_k`.
 
-    X = X.tocsr()
-    data, indices, indptr = X.data, X.indices, X.indptr
-    return _top_k_dense(data, indices, indptr, k)
+    >>> X = np.array([[0.1, 0.5, 0.3, 0.0], [0.9, 0.0, 0.0, 0.2]])
+    >>> top_k_csr(X, 2).toarray().tolist()
+    [[0.0, 0.5, 0.3, 0.0], [0.9, 0.0, 0.0, 0.2]]
+    >>> top_k_csr(X, 2, threshold=0.25).toarray().tolist()
+    [[0.0, 0.5, 0.3, 0.0], [0.9, 0.0, 0.0, 0.0]]
+    >>> (top_k_csr(scipy.sparse.csr_matrix(X), 1) != top_k_csr(X, 1)).nnz
+    0
+    """
+    n, m = X.shape
+    k = min(k, m)
+    if n == 0 or k <= 0:
+        return scipy.sparse.csr_matrix((n, m), dtype=X.dtype)
+
+    indices, data = top_k(X, k, parallel=parallel)
+    keep = indices >= 0
+    if threshold > 0:
+        keep &= data >= threshold
+    rows = np.repeat(np.arange(n), k).reshape(n, k)
+
+    return scipy.sparse.csr_matrix(
+        (data[keep], (rows[keep], indices[keep])), shape=(n, m))
+
+
+@nb.njit()
+def _accumulate_row(i, q_data, q_indices, q_indptr, p_data, p_indices, p_indptr,
+                    acc, touched, marker):
+    # walk the postings of each term in the i-th query, accumulating the
+    # scores in `acc` and keeping track of the touched items in `touched`
+    # (`marker` holds the last row that touched each item)
+    n_touched = 0
+    for q in range(q_indptr[i], q_indptr[i + 1]):
+        term, weight = q_indices[q], q_data[q]
+        for p in range(p_indptr[term], p_indptr[term + 1]):
+            j = p_indices[p]
+            if marker[j] != i:
+                marker[j] = i
+                touched[n_touched] = j
+                n_touched += 1
+            acc[j] += weight * p_data[p]
+    return n_touched
+
+
+@nb.njit()
+def _collect_row(acc, touched, n_touched, selected, threshold, k,
+                 out_indices, out_data):
+    # select the items above threshold (and the top k of them if k > 0),
+    # write them to the output in column order and reset the accumulator
+    n_items = 0
+    for t in range(n_touched):
+        j = touched[t]
+        if acc[j] != 0 and (threshold <= 0 or acc[j] >= threshold):
+            selected[n_items] = j
+            n_items += 1
+    items = selected[:n_items]
+    if k > 0 and n_items > k:
+        scores = np.empty(n_items)
+        for t in range(n_items):
+            scores[t] = acc[items[t]]
+        items = items[np.argsort(-scores)[:k]]
+        n_items = k
+    items = np.sort(items)
+    if out_indices is not None:
+        for t in range(n_items):
+            out_indices[t] = items[t]
+            out_data[t] = acc[items[t]]
+    for t in range(n_touched):
+        acc[touched[t]] = 0
+    return n_items
+
+
+@nb.njit(parallel=True)
+def _sparse_linear_kernel_count(q_data, q_indices, q_indptr,
+                                p_data, p_indices, p_indptr, m, threshold, n_blocks):
+    n = q_indptr.shape[0] - 1
+    counts = np.zeros(n, dtype=np.int64)
+    block_size = (n + n_blocks - 1) // n_blocks
+    for b in nb.prange(n_blocks):
+        acc, touched = np.zeros(m), np.empty(m, dtype=np.int64)
+        selected, marker = np.empty(m, dtype=np.int64), np.full(m, -1, dtype=np.int64)
+        for i in range(b * block_size, min((b + 1) * block_size, n)):
+            n_touched = _accumulate_row(
+                i, q_data, q_indices, q_indptr, p_data, p_indices, p_indptr,
+                acc, touched, marker)
+            counts[i] = _collect_row(
+                acc, touched, n_touched, selected, threshold, 0, None, None)
+    return counts
+
+
+@nb.njit(parallel=True)
+def _sparse_linear_kernel_fill(q_data, q_indices, q_indptr,
+                               p_data, p_indices, p_indptr, m, threshold, k, n_blocks,
+                               indptr, indices, data):
+    # `indptr` holds the output offset of each row, which for k > 0 is simply
+    # i * k, since each row can produce at most k items
+    n = q_indptr.shape[0] - 1
+    counts = np.zeros(n, dtype=np.int64)
+    block_size = (n + n_blocks - 1) // n_blocks
+    for b in nb.prange(n_blocks):
+        acc, touched = np.zeros(m), np.empty(m, dtype=np.int64)
+        selected, marker = np.empty(m, dtype=np.int64), np.full(m, -1, dtype=np.int64)
+        for i in range(b * block_size, min((b + 1) * block_size, n)):
+            n_touched = _accumulate_row(
+                i, q_data, q_indices, q_indptr, p_data, p_indices, p_indptr,
+                acc, touched, marker)
+            start = indptr[i]
+            counts[i] = _collect_row(
+                acc, touched, n_touched, selected, threshold, k,
+                indices[start:], data[start:])
+    return counts
+
+
+# serial versions, used when the caller already runs in parallel processes
+_sparse_linear_kernel_count_serial = nb.njit(cache=True)(_sparse_linear_kernel_count.py_func)
+_sparse_linear_kernel_fill_serial = nb.njit(cache=True)(_sparse_linear_kernel_fill.py_func)
+
+
+def sparse_linear_kernel(X, Y, threshold=0.0, top_k=0, parallel=True):
+    """
+    Sparse version of the linear kernel (X @ Y.T) for CSR inputs that walks the
+    inverted postings of Y and applies the threshold (and optionally a top-k
+    selection) inside the kernel, so that the output is directly produced as
+    a CSR matrix without ever materializing the dense result.
+
+    Arguments
+    =========
+    X : sparse_matrix (n x vocab)
+    Y : sparse_matrix (m x vocab), a CSC matrix is used as is (inverted index)
+    threshold : float, drop similarities below threshold (only if positive)
+    top_k : int, if greater than 0, keep only the top k items per row in X
+    parallel : bool, whether to use multiple threads (disable it when calling
+        from multiple worker processes to avoid oversubscription)
+
+    Output
+    ======
+    scipy.sparse.csr_matrix (n x m)
+
+    >>> X = scipy.sparse.csr_matrix([[1.0, 0.0, 1.0], [0.0, 1.0, 0.0]])
+    >>> Y = scipy.sparse.csr_matrix([[1.0, 0.0, 0.0], [0.5, 0.5, 0.5], [0.0, 0.0, 2.0]])
+    >>> sparse_linear_kernel(X, Y).toarray().tolist()
+    [[1.0, 1.0, 2.0], [0.0, 0.5, 0.0]]
+    >>> sparse_linear_kernel(X, Y, threshold=0.75).toarray().tolist()
+    [[1.0, 1.0, 2.0], [0.0, 0.0, 0.0]]
+    >>> sparse_linear_kernel(X, Y, top_k=1).toarray().tolist()
+    [[0.0, 0.0, 2.0], [0.0, 0.5, 0.0]]
+    >>> sparse_linear_kernel(X, Y[:, :2])
+    Traceback (most recent call last):
+    ...
+    ValueError: Incompatible dimension for X and Y matrices: X.shape[1] == 3 while Y.shape[1] == 2
+    """
+    if X.shape[1] != Y.shape[1]:
+        raise ValueError(
+            "Incompatible dimension for X and Y matrices: "
+            "X.shape[1] == {} while Y.shape[1] == {}".format(X.shape[1], Y.shape[1]))
+
+    X, P = X.tocsr(), Y.tocsc()
+    (n, _), (m, _) = X.shape, Y.shape
+    args = (X.data.astype(np.float64), X.indices, X.indptr,
+            P.data.astype(np.float64), P.indices, P.indptr, m, threshold)
+    n_blocks = max(min(n, nb.config.NUMBA_NUM_THREADS * 4), 1)
+    count, fill = _sparse_linear_kernel_count, _sparse_linear_kernel_fill
+    if not parallel:
+        count, fill = _sparse_linear_kernel_count_serial, _sparse_linear_kernel_fill_serial
+
+    if top_k > 0:
+        top_k = min(top_k, m)
+        indptr = np.arange(n + 1, dtype=np.int64) * top_k
+        indices, data = np.zeros(n * top_k, dtype=np.int64), np.zeros(n * top_k)
+        counts = fill(*args, top_k, n_blocks, indptr, indices, data)
+        # compact the output
+        keep = (np.arange(top_k)[None, :] < counts[:, None]).ravel()
+        indices, data = indices[keep], data[keep]
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+    else:
+        counts = count(*args, n_blocks)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        indices, data = np.zeros(indptr[-1], dtype=np.int64), np.zeros(indptr[-1])
+        fill(*args, 0, n_blocks, indptr, indices, data)
+
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=(n, m))
 
 
 def sparse_chunks(M, chunk_size):
@@ -102,11 +328,80 @@ def sparse_chunks(M, chunk_size):
         yield (start, stop), M[start:stop]
 
 
+class SparseAccumulator:
+    """
+    Collect (row, col, value) triplets chunk by chunk and assemble the final
+    sparse matrix in a single call, avoiding row-by-row assignment into
+    `lil_matrix` or `dok_matrix` objects
+
+    >>> acc = SparseAccumulator((4, 3))
+    >>> acc.add_chunk(0, np.array([[0.5, 0.0, 0.0], [0.0, 0.0, 0.25]]))
+    >>> acc.add_chunk(2, scipy.sparse.csr_matrix([[0.0, 0.0, 0.0], [0.0, 1.0, 0.0]]))
+    >>> acc.add([1], [0], [0.75])
+    >>> acc.nnz
+    4
+    >>> acc.tocsr().toarray().tolist()
+    [[0.5, 0.0, 0.0], [0.75, 0.0, 0.25], [0.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+    """
+    def __init__(self, shape, dtype=np.float64):
+        self.shape = shape
+        self.dtype = dtype
+        self.rows, self.cols, self.data = [], [], []
+
+    @property
+    def nnz(self):
+        return sum(len(data) for data in self.data)
+
+    def add(self, rows, cols, data):
+        """
+        Add arrays of triplets to the accumulator
+        """
+        self.rows.append(np.asarray(rows, dtype=np.int64))
+        self.cols.append(np.asarray(cols, dtype=np.int64))
+        self.data.append(np.asarray(data, dtype=self.dtype))
+
+    def add_chunk(self, offset, X):
+        """
+        Add the nonzero entries of a (dense or sparse) block of rows starting
+        at row `offset` in the output matrix
+        """
+        if scipy.sparse.issparse(X):
+            X = X.tocoo()
+            rows, cols, data = X.row, X.col, X.data
+        else:
+            X = np.asarray(X)
+            rows, cols = np.nonzero(X)
+            data = X[rows, cols]
+        self.add(rows + offset, cols, data)
+
+    def tocsr(self):
+        """
+        Assemble the accumulated triplets into a CSR matrix (duplicate
+        entries are summed)
+        """
+        if not self.data:
+            return scipy.sparse.csr_matrix(self.shape, dtype=self.dtype)
+        rows, cols = np.concatenate(self.rows), np.concatenate(self.cols)
+        data = np.concatenate(self.data)
+        return scipy.sparse.csr_matrix((data, (rows, cols)), shape=self.shape)
+
+
+def _compressed_threshold(X, threshold):
+    # select the entries above threshold directly on the data/indices/indptr
+    # arrays of a CSR (or CSC) matrix, only copying those arrays
+    keep = X.data >= threshold
+    indptr = np.zeros(len(keep) + 1, dtype=X.indptr.dtype)
+    indptr[1:] = np.cumsum(keep)
+    indptr = indptr[X.indptr]
+    return type(X)((X.data[keep], X.indices[keep], indptr), shape=X.shape)
+
+
 def set_threshold(X, threshold, sparse_matrix=scipy.sparse.csr_matrix, copy=False):
     """
     Threshold a matrix on a given (possibly sparse matrix). This function
-    will increase the sparsity of the matrix. If the input is not sparse
-    it will default to numpy functionality.
+    will increase the sparsity of the matrix, dropping all entries below
+    `threshold`. If the input is not sparse it will default to numpy
+    functionality (without modifying the input array).
 
     Arguments
     =========
@@ -137,21 +432,71 @@ def set_threshold(X, threshold, sparse_matrix=scipy.sparse.csr_matrix, copy=Fals
     >>> _ = set_threshold(X, 0.6, copy=False)
     >>> (X != X_orig).nnz > 0
     True
+    >>> X = np.array([[0.5, 0.25], [-0.75, 0.15]])
+    >>> set_threshold(X, 0.2).toarray().tolist()
+    [[0.5, 0.25], [0.0, 0.0]]
+    >>> X.tolist()
+    [[0.5, 0.25], [-0.75, 0.15]]
     """
     if not scipy.sparse.issparse(X):
-        X[np.where(X < threshold)] = 0.0
-        return sparse_matrix(X)
+        X = np.asarray(X)
+        return sparse_matrix(np.where(X >= threshold, X, 0.0))
 
     if copy:
-        X2 = scipy.sparse.dok_matrix(X.shape)
-        for i, j, _ in zip(*scipy.sparse.find(X >= threshold)):
-            X2[i, j] = X[i, j]
-        return sparse_matrix(X2)
+        if not (scipy.sparse.isspmatrix_csr(X) or scipy.sparse.isspmatrix_csc(X)):
+            X = X.tocsr()
+        return sparse_matrix(_compressed_threshold(X, threshold))
 
     if isinstance(X, (scipy.sparse.lil_matrix, scipy.sparse.dok_matrix)):
         raise ValueError("Cannot efficiently drop items on", str(type(X)))
 
-    X.data[np.abs(X.data) < threshold] = 0.0
+    X.data[X.data < threshold] = 0.0
     X.eliminate_zeros()
 
     return X
+
+
+def threshold_sweep(X, thresholds, sparse_matrix=scipy.sparse.csr_matrix):
+    """
+    Threshold a matrix on a list of thresholds, yielding tuples of
+    (threshold, thresholded matrix) in increasing order of threshold. Values
+    are sorted only once, and each step only visits the entries dropped
+    since the previous threshold to update the row counts. The input matrix
+    is never modified.
+
+    Arguments
+    =========
+    X : sparse_matrix or np.array
+    thresholds : iterable of floats
+    sparse_matrix : output sparse matrix type
+
+    >>> X = scipy.sparse.csr_matrix([[0.5, 0.0, 0.25], [0.75, 0.15, 0.0]])
+    >>> for th, X_th in threshold_sweep(X, [0.5, 0.2, 0.8]):
+    ...     print(th, X_th.nnz, X_th.toarray().tolist())
+    0.2 3 [[0.5, 0.0, 0.25], [0.75, 0.0, 0.0]]
+    0.5 2 [[0.5, 0.0, 0.0], [0.75, 0.0, 0.0]]
+    0.8 0 [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]
+    """
+    X = scipy.sparse.csr_matrix(X)
+    if not X.has_canonical_format:
+        X = X.copy()
+        X.sum_duplicates()
+    n, _ = X.shape
+    rows = np.repeat(np.arange(n), np.diff(X.indptr))
+    order = np.argsort(X.data, kind='stable')
+    sorted_data = X.data[order]
+
+    keep = np.ones(len(X.data), dtype=bool)
+    counts = np.diff(X.indptr)
+    prev = 0
+    for threshold in sorted(thresholds):
+        cut = max(np.searchsorted(sorted_data, threshold, side='left'), prev)
+        dropped = order[prev:cut]
+        keep[dropped] = False
+        counts = counts - np.bincount(rows[dropped], minlength=n)
+        prev = cut
+        indptr = np.zeros(n + 1, dtype=X.indptr.dtype)
+        indptr[1:] = np.cumsum(counts)
+        X_th = scipy.sparse.csr_matrix(
+            (X.data[keep], X.indices[keep], indptr), shape=X.shape)
+        yield threshold, sparse_matrix(X_th)
@@ -0,0 +1,46 @@
+
+import unittest
+
+import numpy as np
+import scipy.sparse
+
+from retrieve import sparse_utils
+from retrieve.evaluate import get_metrics, get_thresholded_metrics, ranking_stats_from_tuples
+
+
+class TestThresholdedMetrics(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1001)
+        self.sims = scipy.sparse.random(300, 400, density=0.1, random_state=rng).tocsr()
+        self.refs = []
+        for q in rng.choice(300, size=100, replace=False):
+            # random links and some links to highly ranked items
+            i_idxs = rng.choice(400, size=rng.randint(1, 4), replace=False).tolist()
+            row = self.sims[q].toarray()[0]
+            i_idxs.append(int(np.argsort(row)[::-1][rng.randint(0, 10)]))
+            self.refs.append(([int(q)], i_idxs))
+        self.thresholds = np.linspace(0, 1, 21)
+
+    def test_thresholded_metrics(self):
+        for strict in [False, True]:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                metrics = get_thresholded_metrics(
+                    self.sims, self.refs, self.thresholds, strict=strict)
+            for idx, th in enumerate(self.thresholds):
+                sims = sparse_utils.set_threshold(self.sims, th, copy=True)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    expected = get_metrics(sims, self.refs, strict=strict)
+                self.assertEqual(metrics['nnz'][idx], sims.nnz)
+                for metric, val in expected.items():
+                    np.testing.assert_allclose(metrics[metric][idx], val)
+
+
+class TestRankingStats(unittest.TestCase):
+    def test_fpos_first_doc(self):
+        # a retrieved doc with index 0 is a false positive as any other doc
+        ranking = np.array([[0, -1], [1, 0], [-1, -1]])
+        refs = [([1], [1])]
+        stats, matches = ranking_stats_from_tuples(ranking, refs, at_values=[1, 2])
+        self.assertEqual(matches, [(1, 1, 1)])
+        self.assertEqual([s['fpos'] for s in stats], [1, 1])
+        self.assertEqual([s['tpos'] for s in stats], [1, 1])
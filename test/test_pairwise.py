@@ -0,0 +1,109 @@
+
+import unittest
+
+import numpy as np
+import scipy.sparse
+
+from retrieve.methods import pairwise_kernels_chunked
+from retrieve.sparse_utils import sparse_linear_kernel
+
+from sklearn.metrics import pairwise_kernels
+from sklearn.preprocessing import normalize
+
+
+class TestPairwiseChunked(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1001)
+        self.X = normalize(scipy.sparse.random(250, 500, density=0.02, random_state=rng))
+        self.Y = normalize(scipy.sparse.random(300, 500, density=0.02, random_state=rng))
+        self.sims = pairwise_kernels(self.X, self.Y, metric='linear')
+
+    def test_top_k(self):
+        k = 5
+        for chunk_size in [0, 7, 100, 1000]:
+            sims = pairwise_kernels_chunked(
+                self.X, self.Y, chunk_size=chunk_size, top_k=k)
+            self.assertTrue(scipy.sparse.isspmatrix_csr(sims))
+            self.assertEqual(sims.shape, self.sims.shape)
+            self.assertTrue(np.all(np.diff(sims.indptr) <= k))
+            for i in range(sims.shape[0]):
+                row = sims[i].toarray()[0]
+                expected = np.sort(self.sims[i])[::-1][:k]
+                expected = expected[expected > 0]
+                self.assertTrue(np.allclose(np.sort(row[row > 0])[::-1], expected))
+                # retained values correspond to the true similarities
+                self.assertTrue(np.allclose(row[row > 0], self.sims[i][row > 0]))
+
+    def test_top_k_dense(self):
+        X, Y = self.X.toarray(), self.Y.toarray()
+        sims = pairwise_kernels_chunked(X, Y, top_k=5)
+        self.assertTrue(scipy.sparse.isspmatrix_csr(sims))
+        self.assertTrue(np.allclose(
+            np.sort(sims.toarray(), 1)[:, ::-1][:, :5],
+            np.sort(self.sims, 1)[:, ::-1][:, :5]))
+
+    def test_top_k_threshold(self):
+        sims = pairwise_kernels_chunked(
+            self.X, self.Y, chunk_size=50, top_k=10, threshold=0.1)
+        self.assertTrue(np.all(sims.data >= 0.1))
+        self.assertEqual(
+            sims.nnz, np.minimum((self.sims >= 0.1).sum(1), 10).sum())
+
+    def test_chunked(self):
+        for threshold in [0.0, 0.1]:
+            expected = np.where(self.sims >= threshold, self.sims, 0)
+            for chunk_size in [7, 100, 1000]:
+                sims = pairwise_kernels_chunked(
+                    self.X, self.Y, chunk_size=chunk_size, threshold=threshold)
+                self.assertTrue(scipy.sparse.isspmatrix_csr(sims))
+                self.assertTrue(np.allclose(sims.toarray(), expected))
+
+    def test_processes(self):
+        for top_k in [0, 5]:
+            sims1 = pairwise_kernels_chunked(
+                self.X, self.Y, chunk_size=30, threshold=0.05, top_k=top_k)
+            sims2 = pairwise_kernels_chunked(
+                self.X, self.Y, chunk_size=30, threshold=0.05, top_k=top_k,
+                processes=2)
+            self.assertEqual((sims1 != sims2).nnz, 0)
+
+
+class TestSparseLinearKernel(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1001)
+        self.X = normalize(scipy.sparse.random(250, 500, density=0.02, random_state=rng))
+        self.Y = normalize(scipy.sparse.random(300, 500, density=0.02, random_state=rng))
+        self.sims = pairwise_kernels(self.X, self.Y, metric='linear')
+
+    def test_threshold(self):
+        for threshold in [0.0, 0.05, 0.1, 0.25]:
+            expected = np.where(self.sims >= threshold, self.sims, 0)
+            for parallel in [True, False]:
+                sims = sparse_linear_kernel(
+                    self.X, self.Y, threshold=threshold, parallel=parallel)
+                self.assertTrue(np.allclose(sims.toarray(), expected))
+
+    def test_top_k(self):
+        for k in [1, 5, 50]:
+            for threshold in [0.0, 0.1]:
+                sims = sparse_linear_kernel(self.X, self.Y, threshold=threshold, top_k=k)
+                expected = np.sort(np.where(self.sims >= threshold, self.sims, 0), 1)
+                expected = expected[:, ::-1][:, :k]
+                output = np.sort(sims.toarray(), 1)[:, ::-1][:, :k]
+                self.assertTrue(np.all(np.diff(sims.indptr) <= k))
+                self.assertTrue(np.allclose(output, expected))
+
+    def test_negative(self):
+        X = scipy.sparse.csr_matrix([[1.0, -1.0]])
+        Y = scipy.sparse.csr_matrix([[0.0, 1.0], [1.0, 0.0]])
+        self.assertEqual(sparse_linear_kernel(X, Y).toarray().tolist(), [[-1.0, 1.0]])
+        self.assertEqual(
+            sparse_linear_kernel(X, Y, threshold=0.5).toarray().tolist(), [[0.0, 1.0]])
+
+    def test_shape(self):
+        X = scipy.sparse.csr_matrix(np.ones((2, 50000)))
+        Y = scipy.sparse.csr_matrix(np.ones((2, 3)))
+        with self.assertRaises(ValueError):
+            sparse_linear_kernel(X, Y)
+        with self.assertRaises(ValueError):
+            pairwise_kernels_chunked(X, Y, threshold=0.1)
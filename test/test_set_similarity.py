@@ -0,0 +1,92 @@
+
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from retrieve.methods.set_similarity import SearchIndex, SetSimilarity
+
+
+def get_sets(rng, n, vocab_size=60, max_size=12):
+    # zipfian-like token distribution
+    p = 1 / np.arange(1, vocab_size + 1)
+    p /= p.sum()
+    return [set('w{}'.format(w) for w in rng.choice(
+        vocab_size, size=rng.randint(1, max_size), p=p)) for _ in range(n)]
+
+
+def brute_force(queries, index, similarity_fn, threshold):
+    sims = np.zeros((len(queries), len(index)))
+    for i, s1 in enumerate(queries):
+        for j, s2 in enumerate(index):
+            overlap = len(s1 & s2)
+            if similarity_fn == 'containment':
+                sim = overlap / len(s1)
+            elif similarity_fn == 'jaccard':
+                sim = overlap / len(s1 | s2)
+            elif similarity_fn == 'cosine':
+                sim = overlap / np.sqrt(len(s1) * len(s2))
+            else:
+                sim = overlap / max(len(s1), len(s2))
+            sims[i, j] = sim if sim >= threshold else 0
+    return sims
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1001)
+        self.index = get_sets(rng, 150)
+        self.queries = get_sets(rng, 100)
+
+    def test_query(self):
+        for similarity_fn in ['containment', 'jaccard', 'cosine', 'containment_min']:
+            for threshold in [0.2, 0.5, 0.8]:
+                expected = brute_force(self.queries, self.index, similarity_fn, threshold)
+                sims = SetSimilarity(threshold, similarity_fn).get_similarities(
+                    self.queries, self.index)
+                self.assertTrue(np.allclose(sims.toarray(), expected),
+                                msg='{}: {}'.format(similarity_fn, threshold))
+
+    def test_self_search(self):
+        expected = brute_force(self.index, self.index, 'jaccard', 0.3)
+        np.fill_diagonal(expected, 0)
+        sims = SetSimilarity(0.3, 'jaccard').get_similarities(self.index)
+        self.assertTrue(np.allclose(sims.toarray(), expected))
+
+    def test_save_load(self):
+        search_index = SearchIndex(
+            self.index, similarity_func_name='jaccard', similarity_threshold=0.3)
+        with tempfile.TemporaryDirectory() as path:
+            search_index.save(path)
+            loaded = SearchIndex.load(path)
+            self.assertTrue(isinstance(loaded.set_tokens, np.memmap))
+            # pickled memory-mapped indices are reloaded from disk
+            self.assertLess(len(pickle.dumps(loaded)), 200)
+            for other in [loaded, pickle.loads(pickle.dumps(loaded))]:
+                for query in self.queries:
+                    self.assertEqual(sorted(search_index.query(query)),
+                                     sorted(other.query(query)))
+
+    def test_refit(self):
+        expected = brute_force(self.queries, self.index, 'containment', 0.4)
+        sim = SetSimilarity(0.4, 'containment').fit(self.index)
+        with tempfile.TemporaryDirectory() as path:
+            sim.save(os.path.join(path, 'index'))
+            loaded = SetSimilarity.load(os.path.join(path, 'index'))
+            for sim in [sim, loaded]:
+                # queries include tokens that are missing from the index
+                sims = sim.get_similarities(self.queries + [{'unk1', 'unk2', 'w0'}],
+                                            refit=False)
+                self.assertEqual(sims.shape, (len(self.queries) + 1, len(self.index)))
+                self.assertTrue(np.allclose(sims[:-1].toarray(), expected))
+                self.assertTrue(np.allclose(
+                    sims[-1].toarray(),
+                    brute_force([{'unk1', 'unk2', 'w0'}], self.index, 'containment', 0.4)))
+
+    def test_processes(self):
+        sim = SetSimilarity(0.4, 'jaccard')
+        sims1 = sim.get_similarities(self.queries, self.index)
+        sims2 = sim.get_similarities(self.queries, self.index, processes=2)
+        self.assertEqual((sims1 != sims2).nnz, 0)
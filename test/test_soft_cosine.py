@@ -11,6 +11,7 @@ from retrieve.methods import Tfidf
 from retrieve.methods.vsm.soft_cosine import soft_cosine_similarities, soft_cosine_simple
 
 from sklearn.metrics import pairwise_kernels
+from sklearn.preprocessing import normalize
 
 
 class TestSoftCosine(unittest.TestCase):
@@ -71,3 +72,38 @@ class TestSoftCosine(unittest.TestCase):
         self.assertTrue(
             np.allclose(sims2.todense(), sims1),
             msg="sparse and dense results match")
+
+
+class TestSoftCosineProcesses(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1001)
+        vocab_size = 300
+        self.query = normalize(
+            scipy.sparse.random(120, vocab_size, density=0.05, random_state=rng))
+        self.index = normalize(
+            scipy.sparse.random(90, vocab_size, density=0.05, random_state=rng))
+        embs = normalize(rng.randn(vocab_size, 20))
+        S = embs @ embs.T
+        S[S < 0.4] = 0
+        np.fill_diagonal(S, 1)
+        self.S = S
+
+    def test_dense(self):
+        sims1 = soft_cosine_similarities(
+            self.query, self.index, self.S, chunk_size=17, disable_bar=True)
+        sims2 = soft_cosine_similarities(
+            self.query, self.index, self.S, chunk_size=17, disable_bar=True,
+            processes=2)
+        self.assertFalse(scipy.sparse.issparse(sims2))
+        self.assertTrue(np.allclose(sims1, sims2))
+
+    def test_sparse(self):
+        S = scipy.sparse.csr_matrix(self.S)
+        sims1 = soft_cosine_similarities(
+            self.query, self.index, S, chunk_size=17, threshold=0.1, disable_bar=True)
+        sims2 = soft_cosine_similarities(
+            self.query, self.index, S, chunk_size=17, threshold=0.1, disable_bar=True,
+            processes=2)
+        self.assertTrue(scipy.sparse.issparse(sims2))
+        self.assertEqual(sims1.nnz, sims2.nnz)
+        self.assertTrue(np.allclose(sims1.toarray(), sims2.toarray()))
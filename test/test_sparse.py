@@ -31,3 +31,61 @@ class TestSparse(unittest.TestCase):
                 self.assertEqual(y1.shape, y2.shape)
                 self.assertTrue(np.alltrue(x1 == x2))
                 self.assertTrue(np.alltrue(y1 == y2))
+
+
+class TestTopK(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1001)
+        X = scipy.sparse.random(200, 300, density=0.05, random_state=rng).tolil()
+        # some empty rows and some ties
+        X[:5] = 0
+        X[5, :10] = 1.0
+        self.X = X.tocsr()
+        self.X.eliminate_zeros()
+
+    def test_top_k(self):
+        dense = self.X.toarray()
+        for k in [1, 5, 20, 50]:
+            for parallel in [True, False]:
+                indices, data = sparse_utils.top_k(self.X, k, parallel=parallel)
+                dense_indices, dense_data = sparse_utils.top_k(dense, k, parallel=parallel)
+                self.assertEqual(indices.shape, (self.X.shape[0], k))
+                self.assertTrue(np.array_equal(indices, dense_indices))
+                self.assertTrue(np.array_equal(data, dense_data, equal_nan=True))
+                for i in range(self.X.shape[0]):
+                    row = dense[i][dense[i] != 0]
+                    expected = np.sort(row)[::-1][:k]
+                    n_items = len(expected)
+                    self.assertTrue(np.all(indices[i, n_items:] == -1))
+                    self.assertTrue(np.all(np.isnan(data[i, n_items:])))
+                    self.assertTrue(np.allclose(data[i, :n_items], expected))
+                    self.assertTrue(np.allclose(dense[i, indices[i, :n_items]], expected))
+
+
+class TestSetThreshold(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1001)
+        self.X = scipy.sparse.random(200, 300, density=0.05, random_state=rng).tocsr()
+        self.X.data -= 0.25
+        self.thresholds = np.linspace(-0.5, 1, 20)
+
+    def test_copy(self):
+        X_orig = self.X.copy()
+        for th in self.thresholds:
+            expected = np.where(self.X.toarray() >= th, self.X.toarray(), 0)
+            for X in [self.X, self.X.tocsc(), self.X.tocoo(), self.X.toarray()]:
+                X_th = sparse_utils.set_threshold(X, th, copy=True)
+                self.assertTrue(scipy.sparse.isspmatrix_csr(X_th))
+                self.assertTrue(np.allclose(X_th.toarray(), expected))
+            self.assertEqual((self.X != X_orig).nnz, 0)
+
+    def test_sweep(self):
+        X_orig = self.X.copy()
+        thresholds = []
+        for th, X_th in sparse_utils.threshold_sweep(self.X, self.thresholds[::-1]):
+            thresholds.append(th)
+            expected = sparse_utils.set_threshold(self.X, th, copy=True)
+            self.assertEqual((X_th != expected).nnz, 0)
+            self.assertTrue(X_th.has_sorted_indices)
+        self.assertEqual(thresholds, sorted(self.thresholds))
+        self.assertEqual((self.X != X_orig).nnz, 0)